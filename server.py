@@ -1,167 +1,339 @@
 """
 Agent Monitor - Live UI for watching Claude Code agent activity.
-Zero external dependencies — pure Python stdlib.
+Zero external dependencies — pure Python stdlib. If orjson is installed it is
+used for faster JSON encoding/decoding.
 
 Usage:
     python server.py
     Then open http://localhost:7778
 """
 
+import collections
+import itertools
 import json
+import mmap
 import socket
 import time
-import random
-import string
 import os
 import threading
-import queue
 from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
 from pathlib import Path
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# JSON helpers: dumps returns UTF-8 bytes, loads accepts str or bytes
+if orjson is not None:
+    json_dumps = orjson.dumps
+    json_loads = orjson.loads
+else:
+    def json_dumps(obj):
+        return json.dumps(obj, separators=(",", ":")).encode()
+
+    json_loads = json.loads
+
 PORT = int(os.environ.get("PORT", 7778))
 PUBLIC_DIR = Path(__file__).parent / "public"
 
 MAX_EVENTS = 1000  # Increased for longer sessions
-lock = threading.Lock()
-events = []
-tool_counts = {}
+# Separate locks per structure so readers of one don't block writers of another
+events_lock = threading.Lock()
+stats_lock = threading.Lock()
+files_lock = threading.Lock()
+events = collections.deque(maxlen=MAX_EVENTS)
+events_version = 0  # bumped on every append, used for /api/events ETags
+stats_version = 0  # bumped once tool_counts and the file sets reflect an event
+# ETags embed a per-process token so a restarted server never matches old tags
+ETAG_PREFIX = os.urandom(4).hex()
+tool_counts = collections.Counter()
 files_read = set()
 files_written = set()
+# Sorted views of the file sets, rebuilt lazily when a new path is added
+files_read_sorted = None
+files_written_sorted = None
 
 # Token usage tracking — transcript path discovered from hook events
 transcript_path = None
-usage_cache = {"data": None, "mtime": 0, "last_check": 0}
+# Incremental parse state: offset/totals/msg_count/model carry over between reads
+usage_cache = {
+    "data": None, "mtime": 0, "last_check": 0,
+    "path": None, "size": 0, "offset": 0, "totals": None, "msg_count": 0, "model": None,
+    "version": 0,
+}
+usage_lock = threading.Lock()
 USAGE_CACHE_TTL = 2  # seconds
 
-# SSE: each connected client gets a queue
-sse_clients = []  # list of queue.Queue
+# SSE: frames go straight to a client's socket when it is idle and writable;
+# otherwise into a bounded per-client buffer drained by the client's thread.
+# When a slow client falls behind the oldest frames are evicted and counted.
+# Client dict keys:
+#   sock     the client socket
+#   wlock    held by whoever is writing to sock, keeps frames whole and ordered
+#   pending  bytes that must go out before anything in dq: the unsent tail of
+#            a partly written frame, or a Last-Event-ID replay
+#   dq       deque of buffered frames
+#   evt      threading.Event set when there is something to write
+#   dropped  frames evicted from dq since the last report
+sse_clients = []
 sse_lock = threading.Lock()
+SSE_BUFFER_SIZE = 200
+SSE_HEARTBEAT_SECS = 15  # keep-alive comment when no events arrive
+MSG_DONTWAIT = getattr(socket, "MSG_DONTWAIT", 0)  # not available on Windows
+
+
+def make_etag(kind, version):
+    return f'"{ETAG_PREFIX}-{kind}{version}"'
 
 
 def make_id():
     ts = int(time.time() * 1000)
-    suffix = "".join(random.choices(string.ascii_lowercase + string.digits, k=6))
-    return f"evt_{ts}_{suffix}"
+    return f"evt_{ts}_{os.urandom(3).hex()}"
 
 
 def track_event(event):
-    global transcript_path
-    with lock:
-        events.append(event)
-        if len(events) > MAX_EVENTS:
-            events.pop(0)
-
-        tool = event.get("tool_name", "unknown")
-        tool_counts[tool] = tool_counts.get(tool, 0) + 1
-
-        inp = event.get("tool_input") or {}
-        if tool == "Read" and inp.get("file_path"):
-            files_read.add(inp["file_path"])
-        if tool in ("Edit", "Write") and inp.get("file_path"):
-            files_written.add(inp["file_path"])
-
-        # Discover transcript path from hook events
-        tp = event.get("transcript_path")
-        if tp and os.path.isfile(tp):
-            transcript_path = tp
-
-    # Push to all SSE client queues
+    global transcript_path, files_read_sorted, files_written_sorted
+    global events_version, stats_version
+    with events_lock:
+        events.append(event)  # deque(maxlen) evicts the oldest in O(1)
+        events_version += 1
+
+    tool = event.get("tool_name", "unknown")
+    inp = event.get("tool_input") or {}
+    path = inp.get("file_path")
+    if path:
+        with files_lock:
+            if tool == "Read" and path not in files_read:
+                files_read.add(path)
+                files_read_sorted = None
+            if tool in ("Edit", "Write") and path not in files_written:
+                files_written.add(path)
+                files_written_sorted = None
+
+    # Bump the version last so a reader that sees it also sees the files above
+    with stats_lock:
+        tool_counts[tool] += 1
+        stats_version += 1
+
+    # Discover transcript path from hook events. A single reference store is
+    # atomic under the GIL, so readers just grab the current value.
+    tp = event.get("transcript_path")
+    if tp and os.path.isfile(tp):
+        transcript_path = tp
+
+    # Encode the SSE frame once and push the same bytes to every client buffer
+    frame = sse_frame(event)
     with sse_lock:
-        for q in sse_clients:
-            try:
-                q.put_nowait(event)
-            except queue.Full:
-                pass  # Drop if client is too slow
+        for client in sse_clients:
+            push_frame(client, frame)
+
+
+def sse_frame(event):
+    """Encode an event as an SSE frame; the id lets clients resume with Last-Event-ID."""
+    return b"id: " + event["id"].encode() + b"\ndata: " + json_dumps(event) + b"\n\n"
+
+
+def replay_frames(last_id):
+    """Encode stored events newer than last_id, or all of them if it has been evicted.
+
+    Must be called with sse_lock held so no event is broadcast in between.
+    """
+    with events_lock:
+        backlog = list(events)
+    for i in range(len(backlog) - 1, -1, -1):
+        if backlog[i].get("id") == last_id:
+            backlog = backlog[i + 1:]
+            break
+    return b"".join(sse_frame(e) for e in backlog)
+
+
+def push_frame(client, frame):
+    """Send frame to an SSE client directly if possible, else buffer it.
+
+    Must be called with sse_lock held.
+    """
+    dq = client["dq"]
+    # Fast path: nothing queued and the client thread is not mid-write, so a
+    # non-blocking send keeps ordering and avoids waking the thread at all
+    if MSG_DONTWAIT and not dq and client["wlock"].acquire(blocking=False):
+        try:
+            if not client["pending"]:
+                try:
+                    sent = client["sock"].send(frame, MSG_DONTWAIT)
+                except OSError:
+                    sent = 0  # would block, or dead socket the client thread will reap
+                if sent == len(frame):
+                    return
+                if sent:
+                    client["pending"] = frame[sent:]
+                    client["evt"].set()
+                    return
+        finally:
+            client["wlock"].release()
+
+    if len(dq) == dq.maxlen:
+        client["dropped"] += 1  # append below evicts the oldest frame
+    dq.append(frame)
+    client["evt"].set()
+
+
+def get_sorted_files():
+    """Return sorted file lists, re-sorting only after new paths were added."""
+    global files_read_sorted, files_written_sorted
+    with files_lock:
+        if files_read_sorted is None:
+            files_read_sorted = sorted(files_read)
+        if files_written_sorted is None:
+            files_written_sorted = sorted(files_written)
+        # Cached lists are replaced, never mutated, so handing them out is safe
+        return {"files_read": files_read_sorted, "files_written": files_written_sorted}
+
+
+def read_appended_lines(tp, cache, needle=None):
+    """Return complete JSONL lines appended since cache["offset"], advancing it.
+
+    Transcripts are append-only, so each call only scans the new tail of the
+    memory-mapped file. A trailing line without a newline is still being
+    written and is left for the next call. If needle is given, only lines
+    containing it are returned; the rest are skipped without being copied.
+    """
+    start = cache["offset"]
+    with open(tp, "rb") as f:
+        if os.fstat(f.fileno()).st_size <= start:
+            return []
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            nl = mm.rfind(b"\n", start)
+            if nl == -1:
+                return []
+            end = nl + 1
+            cache["offset"] = end
+            if needle is None:
+                return mm[start:end].splitlines()
+
+            lines = []
+            pos = mm.find(needle, start, end)
+            while pos != -1:
+                line_start = max(mm.rfind(b"\n", start, pos) + 1, start)
+                line_end = mm.find(b"\n", pos, end)
+                lines.append(mm[line_start:line_end])
+                start = line_end + 1
+                pos = mm.find(needle, start, end)
+            return lines
 
 
 def get_usage():
-    """Read transcript JSONL and sum token usage. Cached for performance."""
-    now = time.time()
-    if now - usage_cache["last_check"] < USAGE_CACHE_TTL and usage_cache["data"]:
-        return usage_cache["data"]
+    """Read transcript JSONL and sum token usage. Cached for performance.
 
-    usage_cache["last_check"] = now
-    tp = transcript_path
-    if not tp or not os.path.isfile(tp):
-        return None
+    Returns (usage, etag); the etag changes whenever the usage does.
+    """
+    with usage_lock:
+        now = time.time()
+        if now - usage_cache["last_check"] < USAGE_CACHE_TTL and usage_cache["data"]:
+            return usage_cache["data"], make_etag("u", usage_cache["version"])
 
-    try:
-        mtime = os.path.getmtime(tp)
-        if mtime == usage_cache["mtime"] and usage_cache["data"]:
-            return usage_cache["data"]
-
-        totals = {
-            "input_tokens": 0,
-            "output_tokens": 0,
-            "cache_creation_input_tokens": 0,
-            "cache_read_input_tokens": 0,
-        }
-        msg_count = 0
-        model = None
+        usage_cache["last_check"] = now
+        tp = transcript_path
+        if not tp or not os.path.isfile(tp):
+            return None, None
 
-        with open(tp, "r", encoding="utf-8") as f:
-            for line in f:
-                line = line.strip()
+        try:
+            st = os.stat(tp)
+            if (tp == usage_cache["path"] and st.st_mtime == usage_cache["mtime"]
+                    and st.st_size == usage_cache["size"] and usage_cache["data"]):
+                return usage_cache["data"], make_etag("u", usage_cache["version"])
+
+            # New session or rewritten file: start over from byte 0
+            if tp != usage_cache["path"] or st.st_size < usage_cache["offset"]:
+                usage_cache.update(
+                    path=tp,
+                    offset=0,
+                    totals={
+                        "input_tokens": 0,
+                        "output_tokens": 0,
+                        "cache_creation_input_tokens": 0,
+                        "cache_read_input_tokens": 0,
+                    },
+                    msg_count=0,
+                    model=None,
+                )
+            totals = usage_cache["totals"]
+
+            for line in read_appended_lines(tp, usage_cache, b'"usage"'):
                 if not line:
                     continue
                 try:
-                    obj = json.loads(line)
-                except json.JSONDecodeError:
+                    obj = json_loads(line)
+                except ValueError:
                     continue
                 usage = (obj.get("message") or {}).get("usage")
                 if usage:
-                    msg_count += 1
+                    usage_cache["msg_count"] += 1
                     for k in totals:
                         totals[k] += usage.get(k, 0)
                     m = (obj.get("message") or {}).get("model")
                     if m:
-                        model = m
-
-        result = {
-            **totals,
-            "total_tokens": sum(totals.values()),
-            "api_messages": msg_count,
-            "model": model,
-        }
-        usage_cache["data"] = result
-        usage_cache["mtime"] = mtime
-        return result
-    except Exception:
-        return usage_cache.get("data")
+                        usage_cache["model"] = m
+
+            result = {
+                **totals,
+                "total_tokens": sum(totals.values()),
+                "api_messages": usage_cache["msg_count"],
+                "model": usage_cache["model"],
+            }
+            if result != usage_cache["data"]:
+                usage_cache["data"] = result
+                usage_cache["version"] += 1
+            usage_cache["mtime"] = st.st_mtime
+            usage_cache["size"] = st.st_size
+        except Exception:
+            pass
+        return usage_cache["data"], make_etag("u", usage_cache["version"])
 
 
-# Conversation cache
-convo_cache = {"data": None, "mtime": 0, "last_check": 0}
+# Conversation cache — seen_uuids/messages accumulate across incremental reads
+convo_cache = {
+    "data": None, "mtime": 0, "last_check": 0,
+    "path": None, "size": 0, "offset": 0, "seen_uuids": {}, "messages": [],
+    "version": 0,
+}
+convo_lock = threading.Lock()
 CONVO_CACHE_TTL = 2
 
 
 def get_conversation():
-    """Read transcript JSONL and extract user/assistant messages."""
-    now = time.time()
-    if now - convo_cache["last_check"] < CONVO_CACHE_TTL and convo_cache["data"] is not None:
-        return convo_cache["data"]
+    """Read transcript JSONL and extract user/assistant messages.
 
-    convo_cache["last_check"] = now
-    tp = transcript_path
-    if not tp or not os.path.isfile(tp):
-        return None
+    Returns (messages, etag); the etag changes whenever the messages do.
+    """
+    with convo_lock:
+        now = time.time()
+        if now - convo_cache["last_check"] < CONVO_CACHE_TTL and convo_cache["data"] is not None:
+            return convo_cache["data"], make_etag("c", convo_cache["version"])
 
-    try:
-        mtime = os.path.getmtime(tp)
-        if mtime == convo_cache["mtime"] and convo_cache["data"] is not None:
-            return convo_cache["data"]
-
-        messages = []
-        seen_uuids = {}  # track latest version of each message by uuid
+        convo_cache["last_check"] = now
+        tp = transcript_path
+        if not tp or not os.path.isfile(tp):
+            return None, None
 
-        with open(tp, "r", encoding="utf-8") as f:
-            for line in f:
-                line = line.strip()
+        try:
+            st = os.stat(tp)
+            if (tp == convo_cache["path"] and st.st_mtime == convo_cache["mtime"]
+                    and st.st_size == convo_cache["size"] and convo_cache["data"] is not None):
+                return convo_cache["data"], make_etag("c", convo_cache["version"])
+
+            # New session or rewritten file: start over from byte 0
+            if tp != convo_cache["path"] or st.st_size < convo_cache["offset"]:
+                convo_cache.update(path=tp, offset=0, seen_uuids={}, messages=[])
+            messages = convo_cache["messages"]
+            seen_uuids = convo_cache["seen_uuids"]  # latest version of each message by uuid
+
+            for line in read_appended_lines(tp, convo_cache):
                 if not line:
                     continue
                 try:
-                    obj = json.loads(line)
-                except json.JSONDecodeError:
+                    obj = json_loads(line)
+                except ValueError:
                     continue
 
                 msg = obj.get("message") or {}
@@ -205,28 +377,31 @@ def get_conversation():
                         else:
                             messages.append(entry)
 
-        # Build final list from seen_uuids (keeps last version of each)
-        # plus any messages without uuids
-        uuid_msgs = sorted(seen_uuids.values(), key=lambda m: m.get("timestamp") or "")
-        all_msgs = uuid_msgs + messages
-        all_msgs.sort(key=lambda m: m.get("timestamp") or "")
-
-        # Deduplicate by keeping only the latest entry per uuid
-        result = []
-        seen = set()
-        for m in all_msgs:
-            uid = m.get("uuid")
-            if uid:
-                if uid in seen:
-                    continue
-                seen.add(uid)
-            result.append(m)
-
-        convo_cache["data"] = result
-        convo_cache["mtime"] = mtime
-        return result
-    except Exception:
-        return convo_cache.get("data")
+            # Build final list from seen_uuids (keeps last version of each)
+            # plus any messages without uuids
+            uuid_msgs = sorted(seen_uuids.values(), key=lambda m: m.get("timestamp") or "")
+            all_msgs = uuid_msgs + messages
+            all_msgs.sort(key=lambda m: m.get("timestamp") or "")
+
+            # Deduplicate by keeping only the latest entry per uuid
+            result = []
+            seen = set()
+            for m in all_msgs:
+                uid = m.get("uuid")
+                if uid:
+                    if uid in seen:
+                        continue
+                    seen.add(uid)
+                result.append(m)
+
+            if result != convo_cache["data"]:
+                convo_cache["data"] = result
+                convo_cache["version"] += 1
+            convo_cache["mtime"] = st.st_mtime
+            convo_cache["size"] = st.st_size
+        except Exception:
+            pass
+        return convo_cache["data"], make_etag("c", convo_cache["version"])
 
 
 class Handler(SimpleHTTPRequestHandler):
@@ -241,15 +416,29 @@ class Handler(SimpleHTTPRequestHandler):
     def log_message(self, fmt, *args):
         pass
 
-    def send_json(self, data, status=200):
-        body = json.dumps(data).encode()
+    def send_json(self, data, status=200, etag=None):
+        body = json_dumps(data)
         self.send_response(status)
         self.send_header("Content-Type", "application/json")
         self.send_header("Access-Control-Allow-Origin", "*")
+        if etag:
+            # Let browsers cache the body but revalidate it on every poll
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", "no-cache")
         self.send_header("Content-Length", str(len(body)))
         self.end_headers()
         self.wfile.write(body)
 
+    def not_modified(self, etag):
+        """Reply 304 and return True if the client already has this version."""
+        if not etag or self.headers.get("If-None-Match") != etag:
+            return False
+        self.send_response(304)
+        self.send_header("ETag", etag)
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.end_headers()
+        return True
+
     def do_OPTIONS(self):
         self.send_response(204)
         self.send_header("Access-Control-Allow-Origin", "*")
@@ -262,8 +451,8 @@ class Handler(SimpleHTTPRequestHandler):
             length = int(self.headers.get("Content-Length", 0))
             body = self.rfile.read(length)
             try:
-                data = json.loads(body)
-            except (json.JSONDecodeError, UnicodeDecodeError):
+                data = json_loads(body)
+            except ValueError:
                 self.send_json({"error": "bad json"}, 400)
                 return
             event = {**data, "timestamp": int(time.time() * 1000), "id": make_id()}
@@ -273,40 +462,60 @@ class Handler(SimpleHTTPRequestHandler):
             self.send_json({"error": "not found"}, 404)
 
     def do_GET(self):
+        handler = self._routes_get.get(self.path)
+        if handler:
+            handler(self)
+            return
         if self.path.startswith("/api/stream"):
             self._handle_sse()
             return
-        if self.path == "/api/events":
-            with lock:
-                snapshot = list(events[-200:])
-            self.send_json({"events": snapshot})
-            return
-        if self.path == "/api/stats":
-            with lock:
-                self.send_json({
-                    "tool_counts": dict(tool_counts),
-                    "files_read": sorted(files_read),
-                    "files_written": sorted(files_written),
-                })
-            return
-        if self.path == "/api/usage":
-            usage = get_usage()
-            if usage:
-                self.send_json(usage)
-            else:
-                self.send_json({"error": "no transcript found yet"}, 404)
+        super().do_GET()
+
+    def _api_events(self):
+        if self.not_modified(make_etag("e", events_version)):
             return
-        if self.path == "/api/conversation":
-            convo = get_conversation()
-            if convo is not None:
-                self.send_json({"messages": convo})
-            else:
-                self.send_json({"error": "no transcript found yet"}, 404)
+        with events_lock:
+            snapshot = list(itertools.islice(events, max(0, len(events) - 200), None))
+            etag = make_etag("e", events_version)
+        self.send_json({"events": snapshot}, etag=etag)
+
+    def _api_stats(self):
+        if self.not_modified(make_etag("s", stats_version)):
             return
-        super().do_GET()
+        with stats_lock:
+            counts = tool_counts.copy()
+            etag = make_etag("s", stats_version)
+        self.send_json({
+            "tool_counts": counts,
+            **get_sorted_files(),
+        }, etag=etag)
+
+    def _api_usage(self):
+        usage, etag = get_usage()
+        if usage:
+            if not self.not_modified(etag):
+                self.send_json(usage, etag=etag)
+        else:
+            self.send_json({"error": "no transcript found yet"}, 404)
+
+    def _api_conversation(self):
+        convo, etag = get_conversation()
+        if convo is not None:
+            if not self.not_modified(etag):
+                self.send_json({"messages": convo}, etag=etag)
+        else:
+            self.send_json({"error": "no transcript found yet"}, 404)
+
+    # Exact-path GET routes, resolved with a single dict lookup
+    _routes_get = {
+        "/api/events": _api_events,
+        "/api/stats": _api_stats,
+        "/api/usage": _api_usage,
+        "/api/conversation": _api_conversation,
+    }
 
     def _handle_sse(self):
-        """Server-Sent Events with per-client queue."""
+        """Server-Sent Events with a per-client frame buffer."""
         self.send_response(200)
         self.send_header("Content-Type", "text/event-stream")
         self.send_header("Cache-Control", "no-cache")
@@ -317,49 +526,77 @@ class Handler(SimpleHTTPRequestHandler):
 
         self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
-        # Create a queue for this client
-        client_queue = queue.Queue(maxsize=200)
+        # Register this client for direct sends and buffered delivery
+        client = {
+            "sock": self.request,
+            "wlock": threading.Lock(),
+            "pending": b"",
+            "dq": collections.deque(maxlen=SSE_BUFFER_SIZE),
+            "evt": threading.Event(),
+            "dropped": 0,
+        }
+        # A reconnecting client catches up from the ring buffer. The replay is
+        # queued as pending so it is written before any newer frame; events
+        # broadcast while we register may repeat, and the UI dedupes by id.
+        last_id = self.headers.get("Last-Event-ID")
         with sse_lock:
-            sse_clients.append(client_queue)
+            if last_id:
+                client["pending"] = replay_frames(last_id)
+                client["evt"].set()
+            sse_clients.append(client)
 
         try:
             while True:
-                # Drain all available events from queue
-                sent = False
-                try:
-                    while True:
-                        evt = client_queue.get_nowait()
-                        data = json.dumps(evt)
-                        self.wfile.write(f"data: {data}\n\n".encode())
-                        sent = True
-                except queue.Empty:
-                    pass
-
-                if sent:
+                # Sleep until a producer signals; a timeout means we are idle
+                signalled = client["evt"].wait(timeout=SSE_HEARTBEAT_SECS)
+                client["evt"].clear()
+
+                with client["wlock"]:
+                    # Finish a partly sent frame or write the replay first
+                    buf = bytearray(client["pending"])
+                    client["pending"] = b""
+
+                    # Tell the client how many frames it missed so it can resync
+                    with sse_lock:
+                        dropped, client["dropped"] = client["dropped"], 0
+                    if dropped:
+                        buf += f": dropped {dropped}\n\n".encode()
+
+                    # Drain all buffered frames into a single write
+                    try:
+                        while True:
+                            buf += client["dq"].popleft()
+                    except IndexError:
+                        pass
+
+                    if not buf:
+                        if signalled:
+                            continue
+                        buf += b": hb\n\n"
+                    self.wfile.write(buf)
                     self.wfile.flush()
-
-                # Heartbeat
-                self.wfile.write(b": hb\n\n")
-                self.wfile.flush()
-
-                time.sleep(0.3)
         except (BrokenPipeError, ConnectionResetError, ConnectionAbortedError, OSError):
             pass
         finally:
             with sse_lock:
                 try:
-                    sse_clients.remove(client_queue)
+                    sse_clients.remove(client)
                 except ValueError:
                     pass
 
 
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # socketserver's default listen backlog of 5 refuses hook POSTs during bursts
+    request_queue_size = 128
+
+
 def main():
     print(f"\n  Agent Monitor")
     print(f"  Dashboard:  http://localhost:{PORT}")
     print(f"  POST hook:  http://localhost:{PORT}/event\n")
 
-    server = ThreadingHTTPServer(("0.0.0.0", PORT), Handler)
-    server.daemon_threads = True
+    server = Server(("0.0.0.0", PORT), Handler)
 
     try:
         server.serve_forever()
@@ -5,6 +5,7 @@ Run: python setup.py
 
 import json
 import os
+import shutil
 import sys
 from pathlib import Path
 
@@ -55,10 +56,24 @@ for hook_type in ("PreToolUse", "PostToolUse"):
     else:
         hooks.append(dict(hook_entry))
 
-# Write settings
-settings_path.write_text(json.dumps(settings, indent=2) + "\n", "utf-8")
-
-print("\n  Hooks configured successfully!")
+# Write settings atomically, and only if something changed
+new_bytes = (json.dumps(settings, indent=2) + "\n").encode("utf-8")
+if settings_path.exists() and settings_path.read_bytes() == new_bytes:
+    print("\n  Hooks already configured, settings.json unchanged")
+else:
+    # Replace the real file behind any symlink, keeping its permissions
+    target = settings_path.resolve()
+    tmp_path = target.with_name(target.name + ".tmp")
+    try:
+        tmp_path.touch()
+        if target.exists():
+            shutil.copymode(target, tmp_path)
+        tmp_path.write_bytes(new_bytes)
+    except OSError:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    os.replace(tmp_path, target)
+    print("\n  Hooks configured successfully!")
 print("\n  Next steps:")
 print("    1. Run:  python server.py     (starts the monitor)")
 print("    2. Open: http://localhost:7778")